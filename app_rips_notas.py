@@ -1,12 +1,110 @@
 import json
-import copy
-from io import BytesIO
+import functools
+import hashlib
+import math
+from io import BytesIO, TextIOWrapper
 from typing import Dict, Any, List, Tuple, Optional
 
 import pandas as pd
 import streamlit as st
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
+from xml.sax.saxutils import escape
+
+try:
+    import orjson
+except ImportError:  # orjson es opcional: sin él se usa json de la librería estándar
+    orjson = None
+
+try:
+    import xxhash
+except ImportError:  # xxhash es opcional: sin él las huellas se calculan con blake2b de hashlib
+    xxhash = None
+
+
+# ==========================
+# Serialización JSON
+# ==========================
+
+def leer_json(raw: Any) -> Any:
+    """
+    Parsea JSON desde bytes o str, con orjson si está disponible.
+    Si orjson lo rechaza se reintenta con json, que acepta lo mismo que antes (BOM UTF-8,
+    NaN) y da el mensaje de error detallado cuando el JSON de verdad es inválido.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(raw)
+
+
+def contiene_no_finitos(obj: Any) -> bool:
+    """True si la estructura JSON tiene algún float NaN o infinito."""
+    t = type(obj)
+    if t is float:
+        return not math.isfinite(obj)
+    if t is dict:
+        obj = obj.values()
+    elif t is not list:
+        return False
+    for v in obj:
+        tv = type(v)
+        if tv is float:
+            if not math.isfinite(v):
+                return True
+        elif (tv is dict or tv is list) and contiene_no_finitos(v):
+            return True
+    return False
+
+
+def serializar_json(obj: Any, indentar: bool = False) -> bytes:
+    """
+    Serializa a JSON UTF-8 (bytes). Usa orjson si está instalado y recurre a json
+    si no lo está o si orjson no soporta algún valor (p. ej. enteros de más de 64 bits).
+    orjson escribe NaN e infinito como null; leer_json sí los acepta, así que con ellos
+    se usa json, que los conserva. Solo se revisa la estructura si la salida tiene null.
+    """
+    if orjson is not None:
+        opciones = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        if indentar:
+            opciones |= orjson.OPT_INDENT_2
+        try:
+            datos = orjson.dumps(obj, option=opciones)
+        except orjson.JSONEncodeError:
+            pass
+        else:
+            if b"null" not in datos or not contiene_no_finitos(obj):
+                return datos
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indentar else None).encode("utf-8")
+
+
+CONTENEDORES_JSON = (dict, list)
+
+
+def clonar_json(obj: Any) -> Any:
+    """
+    Copia profunda de una estructura JSON (dict/list/str/números/bool/None).
+    Solo se copian dicts y listas: los valores atómicos son inmutables y se comparten, así que
+    no hace falta el memo ni el despacho por tipo de copy.deepcopy, y los valores quedan
+    idénticos (un ida y vuelta por orjson convertiría NaN en None).
+    """
+    t = type(obj)
+    if t is dict:
+        return {k: clonar_json(v) if type(v) in CONTENEDORES_JSON else v for k, v in obj.items()}
+    if t is list:
+        return [clonar_json(v) if type(v) in CONTENEDORES_JSON else v for v in obj]
+    return obj
+
+
+def huella_json(obj: Any) -> str:
+    """
+    Huella hexadecimal de 128 bits del JSON compacto de 'obj'. Las claves no se ordenan
+    porque su orden sí cambia la plantilla y el XML generados.
+    """
+    datos = serializar_json(obj)
+    if xxhash is not None:
+        return xxhash.xxh3_128_hexdigest(datos)
+    return hashlib.blake2b(datos, digest_size=16).hexdigest()
 
 
 # ==========================
@@ -15,12 +113,12 @@ from xml.dom import minidom
 
 def tiene_lista_con_items(servicios: Any) -> bool:
     """Retorna True si el diccionario 'servicios' tiene al menos una lista con 1 item."""
-    if not isinstance(servicios, dict):
+    if type(servicios) is not dict:
         return False
-    for v in servicios.values():
-        if isinstance(v, list) and len(v) > 0:
-            return True
-    return False
+    return any(v for v in servicios.values() if type(v) is list)
+
+
+CAMPOS_SIGNO = ("vrServicio", "valorPagoModerador")
 
 
 def ajustar_signo_servicios(servicios: Dict[str, Any], signo: int) -> None:
@@ -28,15 +126,19 @@ def ajustar_signo_servicios(servicios: Dict[str, Any], signo: int) -> None:
     Multiplica por 'signo' algunos campos numéricos típicos de RIPS en todas las listas de servicios.
     Esto permite, por ejemplo, convertir una factura en nota crédito usando valores negativos.
     """
+    if signo == 1:
+        return
+    negar = signo == -1
     for lista in servicios.values():
         if not isinstance(lista, list):
             continue
         for item in lista:
             if not isinstance(item, dict):
                 continue
-            for campo in ("vrServicio", "valorPagoModerador"):
-                if campo in item and isinstance(item[campo], (int, float)):
-                    item[campo] = item[campo] * signo
+            for campo in CAMPOS_SIGNO:
+                v = item.get(campo)
+                if isinstance(v, (int, float)):
+                    item[campo] = -v if negar else v * signo
 
 
 def copiar_servicios_factura_a_nota(
@@ -52,19 +154,19 @@ def copiar_servicios_factura_a_nota(
     inv_users = factura.get("usuarios", [])
     note_users = nota.get("usuarios", [])
 
-    inv_map_full: Dict[Tuple[str, str], Dict[str, Any]] = {}
-    inv_map_by_num: Dict[str, Dict[str, Any]] = {}
-
-    for u in inv_users:
-        tipo = u.get("tipoDocumentoIdentificacion")
-        num = u.get("numDocumentoIdentificacion")
-        servicios = u.get("servicios", {})
-        if tipo is None or num is None:
-            continue
-        inv_map_full[(tipo, num)] = servicios
-        inv_map_by_num[num] = servicios
+    # Usuarios de la factura con tipo y número de documento
+    pares_factura = [
+        (clave, u.get("servicios", {}))
+        for u in inv_users
+        if None not in (clave := (u.get("tipoDocumentoIdentificacion"), u.get("numDocumentoIdentificacion")))
+    ]
+    # (tipo, num) para la coincidencia completa y (None, num) para la de solo número
+    inv_map: Dict[Tuple[Optional[str], str], Dict[str, Any]] = {
+        (None, clave[1]): serv for clave, serv in pares_factura
+    }
+    inv_map.update(pares_factura)
 
-    modificados = 0
+    nuevos: List[Tuple[Dict[str, Any], Dict[str, Any]]] = []
     ya_tenian_servicios = 0
     sin_encontrar: List[Tuple[str, str]] = []
 
@@ -79,18 +181,22 @@ def copiar_servicios_factura_a_nota(
             ya_tenian_servicios += 1
             continue
 
-        servicios_origen = inv_map_full.get(key_full) or inv_map_by_num.get(num)
+        servicios_origen = inv_map.get(key_full) or inv_map.get((None, num))
 
         if servicios_origen is None:
             sin_encontrar.append(key_full)
             continue
 
-        nuevo_servicios = copy.deepcopy(servicios_origen)
+        nuevo_servicios = clonar_json(servicios_origen)
         if forzar_signo in (1, -1):
             ajustar_signo_servicios(nuevo_servicios, forzar_signo)
 
+        nuevos.append((u, nuevo_servicios))
+
+    # Se asigna al final: si algo falla antes, la nota queda sin cambios
+    for u, nuevo_servicios in nuevos:
         u["servicios"] = nuevo_servicios
-        modificados += 1
+    modificados = len(nuevos)
 
     resumen = {
         "total_usuarios_factura": len(inv_users),
@@ -121,28 +227,37 @@ def generar_resumen_usuarios(nota: Dict[str, Any]) -> pd.DataFrame:
     - numListasServicios
     - totalItemsServicios
     """
-    filas: List[Dict[str, Any]] = []
+    idx_col: List[int] = []
+    tipo_col: List[Any] = []
+    num_col: List[Any] = []
+    estado_col: List[str] = []
+    listas_col: List[int] = []
+    items_col: List[int] = []
     for idx, u in enumerate(nota.get("usuarios", [])):
         servicios = u.get("servicios", {})
-        tiene_serv = tiene_lista_con_items(servicios)
-        num_listas = 0
-        total_items = 0
+        num_listas = total_items = 0
         if isinstance(servicios, dict):
             for v in servicios.values():
-                if isinstance(v, list):
+                if type(v) is list:
                     num_listas += 1
                     total_items += len(v)
-        filas.append(
-            {
-                "idx": idx,
-                "tipoDocumentoIdentificacion": u.get("tipoDocumentoIdentificacion"),
-                "numDocumentoIdentificacion": u.get("numDocumentoIdentificacion"),
-                "estadoServicios": "OK" if tiene_serv else "INCOMPLETO",
-                "numListasServicios": num_listas,
-                "totalItemsServicios": total_items,
-            }
-        )
-    return pd.DataFrame(filas)
+        idx_col.append(idx)
+        tipo_col.append(u.get("tipoDocumentoIdentificacion"))
+        num_col.append(u.get("numDocumentoIdentificacion"))
+        estado_col.append("OK" if total_items > 0 else "INCOMPLETO")
+        listas_col.append(num_listas)
+        items_col.append(total_items)
+    return pd.DataFrame(
+        {
+            "idx": idx_col,
+            "tipoDocumentoIdentificacion": tipo_col,
+            "numDocumentoIdentificacion": num_col,
+            "estadoServicios": estado_col,
+            "numListasServicios": listas_col,
+            "totalItemsServicios": items_col,
+        },
+        copy=False,
+    )
 
 
 # ==========================
@@ -206,8 +321,9 @@ def desglosar_servicios_usuario(
                 "idx_item": idx_item,
             }
             faltantes: List[str] = []
+            obtener = item.get
             for clave in claves_esperadas:
-                valor = item.get(clave)
+                valor = obtener(clave)
                 fila[clave] = valor
                 if valor in (None, ""):
                     faltantes.append(clave)
@@ -221,6 +337,53 @@ def desglosar_servicios_usuario(
 # Plantilla masiva por servicio
 # ==========================
 
+COLUMNAS_PLANTILLA = (
+    "idx_usuario",
+    "tipoDocumentoIdentificacion",
+    "numDocumentoIdentificacion",
+    "tipo_servicio",
+    "idx_item",
+    "vrServicio_factura",
+    "vrServicio_nota",
+    "campos_faltantes_nota",
+)
+
+
+def escribir_plantilla_xlsx(buffer: BytesIO, columnas: Dict[str, List[Any]]) -> None:
+    """
+    Escribe la hoja 'servicios' fila por fila, sin estilos: con xlsxwriter en modo
+    constant_memory si está instalado, si no con openpyxl en modo write-only.
+    Lanza ImportError si no hay ninguno de los dos.
+    """
+    filas = zip(*columnas.values())
+    try:
+        import xlsxwriter
+    except ImportError:
+        from openpyxl import Workbook
+
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("servicios")
+        ws.append(COLUMNAS_PLANTILLA)
+        for fila in filas:
+            ws.append(fila)
+        wb.save(buffer)
+        return
+
+    # Un NaN del JSON se escribe como #NUM!; los textos se escriben tal cual, como con openpyxl
+    opciones = {
+        "constant_memory": True,
+        "nan_inf_to_errors": True,
+        "strings_to_numbers": False,
+        "strings_to_urls": False,
+    }
+    wb = xlsxwriter.Workbook(buffer, opciones)
+    ws = wb.add_worksheet("servicios")
+    ws.write_row(0, 0, COLUMNAS_PLANTILLA)
+    for num_fila, fila in enumerate(filas, start=1):
+        ws.write_row(num_fila, 0, fila)
+    wb.close()
+
+
 def generar_plantilla_servicios(
     nota: Dict[str, Any],
     factura: Optional[Dict[str, Any]],
@@ -234,67 +397,78 @@ def generar_plantilla_servicios(
       se generan filas base para ese usuario usando la factura.
     """
     claves_esperadas = obtener_claves_servicio_esperadas(factura, nota)
-    filas: List[Dict[str, Any]] = []
+    # Valores de cada columna de la plantilla, en el orden de COLUMNAS_PLANTILLA
+    columnas: Dict[str, List[Any]] = {col: [] for col in COLUMNAS_PLANTILLA}
+    (
+        idx_usuario_col,
+        tipo_doc_col,
+        num_doc_col,
+        tipo_serv_col,
+        idx_item_col,
+        vr_fac_col,
+        vr_nota_col,
+        faltantes_col,
+    ) = columnas.values()
 
     usuarios_nota = nota.get("usuarios", []) or []
     usuarios_fac = factura.get("usuarios", []) if factura else []
+    # vrServicio solo se reporta si es una de las claves esperadas
+    leer_vr = "vrServicio" in claves_esperadas
 
     for idx_u in range(len(usuarios_nota)):
         u_nota = usuarios_nota[idx_u]
         u_fac = usuarios_fac[idx_u] if 0 <= idx_u < len(usuarios_fac) else None
+        u_tipo = u_nota.get("tipoDocumentoIdentificacion")
+        u_num = u_nota.get("numDocumentoIdentificacion")
 
         filas_nota = desglosar_servicios_usuario(u_nota, claves_esperadas)
-        filas_fac = desglosar_servicios_usuario(u_fac, claves_esperadas) if u_fac else []
 
-        map_fac: Dict[Tuple[str, int], Dict[str, Any]] = {}
-        for f in filas_fac:
-            key = (f["tipo_servicio"], f["idx_item"])
-            map_fac[key] = f
+        # vrServicio de la factura por (tipo_servicio, idx_item)
+        vr_fac: Dict[Tuple[str, int], Any] = {}
+        servicios_fac = (u_fac.get("servicios") or {}) if u_fac else {}
+        if isinstance(servicios_fac, dict):
+            for tipo_serv, lista in servicios_fac.items():
+                if not isinstance(lista, list):
+                    continue
+                for idx_item, item in enumerate(lista):
+                    vr_fac[(tipo_serv, idx_item)] = item.get("vrServicio") if leer_vr else None
 
         if filas_nota:
             # Usuario ya tiene servicios en la nota
             for f in filas_nota:
                 key = (f["tipo_servicio"], f["idx_item"])
-                base_fac = map_fac.get(key, {})
-                filas.append(
-                    {
-                        "idx_usuario": idx_u,
-                        "tipoDocumentoIdentificacion": u_nota.get("tipoDocumentoIdentificacion"),
-                        "numDocumentoIdentificacion": u_nota.get("numDocumentoIdentificacion"),
-                        "tipo_servicio": f["tipo_servicio"],
-                        "idx_item": f["idx_item"],
-                        "vrServicio_factura": base_fac.get("vrServicio") if base_fac else None,
-                        "vrServicio_nota": f.get("vrServicio"),
-                        "campos_faltantes_nota": f.get("campos_faltantes", ""),
-                    }
-                )
+                idx_usuario_col.append(idx_u)
+                tipo_doc_col.append(u_tipo)
+                num_doc_col.append(u_num)
+                tipo_serv_col.append(f["tipo_servicio"])
+                idx_item_col.append(f["idx_item"])
+                vr_fac_col.append(vr_fac.get(key))
+                vr_nota_col.append(f.get("vrServicio"))
+                faltantes_col.append(f.get("campos_faltantes", ""))
         else:
             # Usuario no tiene servicios en la nota; si hay en factura, generamos filas base
-            for f in filas_fac:
-                filas.append(
-                    {
-                        "idx_usuario": idx_u,
-                        "tipoDocumentoIdentificacion": u_nota.get("tipoDocumentoIdentificacion"),
-                        "numDocumentoIdentificacion": u_nota.get("numDocumentoIdentificacion"),
-                        "tipo_servicio": f["tipo_servicio"],
-                        "idx_item": f["idx_item"],
-                        "vrServicio_factura": f.get("vrServicio"),
-                        "vrServicio_nota": None,
-                        "campos_faltantes_nota": "TODOS (usuario sin estructura de servicios en nota)",
-                    }
-                )
+            for (tipo_serv, idx_item), vr in vr_fac.items():
+                idx_usuario_col.append(idx_u)
+                tipo_doc_col.append(u_tipo)
+                num_doc_col.append(u_num)
+                tipo_serv_col.append(tipo_serv)
+                idx_item_col.append(idx_item)
+                vr_fac_col.append(vr)
+                vr_nota_col.append(None)
+                faltantes_col.append("TODOS (usuario sin estructura de servicios en nota)")
 
-    df = pd.DataFrame(filas)
     buffer = BytesIO()
     ext = "xlsx"
     mime = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
 
     try:
-        with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-            df.to_excel(writer, index=False, sheet_name="servicios")
+        escribir_plantilla_xlsx(buffer, columnas)
     except (ModuleNotFoundError, ImportError):
-        buffer = BytesIO()
-        df.to_csv(buffer, index=False)
+        buffer.seek(0)
+        buffer.truncate(0)
+        pd.DataFrame(columnas, copy=False).to_csv(
+            buffer, index=False, encoding="utf-8", lineterminator="\n"
+        )
         ext = "csv"
         mime = "text/csv"
 
@@ -315,43 +489,73 @@ def aplicar_plantilla_servicios(
     """
     errores: List[str] = []
 
+    obligatorias = ["idx_usuario", "tipo_servicio", "idx_item", "vrServicio_nota"]
+    # Solo se leen las columnas que se aplican; las demás de la plantilla son de referencia
+    lectura = {"usecols": lambda col: col in obligatorias, "dtype": {"tipo_servicio": str}}
+
     try:
         nombre = getattr(archivo_plantilla, "name", "") or ""
         if nombre.lower().endswith(".csv"):
-            df = pd.read_csv(archivo_plantilla)
+            df = pd.read_csv(archivo_plantilla, **lectura)
         else:
-            df = pd.read_excel(archivo_plantilla)
+            try:
+                # python-calamine, con pandas >= 2.2
+                df = pd.read_excel(archivo_plantilla, engine="calamine", **lectura)
+            except (ImportError, ValueError):
+                # Sin calamine o con pandas < 2.2: openpyxl
+                archivo_plantilla.seek(0)
+                df = pd.read_excel(archivo_plantilla, engine="openpyxl", **lectura)
     except Exception as exc:
         errores.append(f"No se pudo leer el archivo de plantilla (xlsx/csv): {exc}")
         return nota, errores
 
-    obligatorias = ["idx_usuario", "tipo_servicio", "idx_item", "vrServicio_nota"]
-    for col in obligatorias:
-        if col not in df.columns:
-            errores.append(f"Falta columna obligatoria '{col}' en la plantilla.")
-            return nota, errores
+    columnas = set(df.columns)
+    if not columnas.issuperset(obligatorias):
+        col = next(c for c in obligatorias if c not in columnas)
+        errores.append(f"Falta columna obligatoria '{col}' en la plantilla.")
+        return nota, errores
 
     usuarios_nota = nota.get("usuarios", [])
     usuarios_fac = factura.get("usuarios", []) if factura else []
 
-    for _, fila in df.iterrows():
-        try:
-            idx_u = int(fila["idx_usuario"])
-        except Exception:
-            errores.append(f"Índice de usuario inválido: {fila.get('idx_usuario')}")
-            continue
-
-        tipo_serv = str(fila["tipo_servicio"])
-        try:
-            idx_item = int(fila["idx_item"])
-        except Exception:
-            errores.append(f"Índice de ítem inválido para usuario {idx_u}: {fila.get('idx_item')}")
-            continue
+    # Solo se aplican las filas con vrServicio_nota diligenciado
+    df = df.loc[df["vrServicio_nota"].notna()]
+
+    # Lo que no es numérico queda en NaN y se reporta como error
+    u_num = pd.to_numeric(df["idx_usuario"], errors="coerce")
+    i_num = pd.to_numeric(df["idx_item"], errors="coerce")
+    v_num = pd.to_numeric(df["vrServicio_nota"], errors="coerce")
+    # Las claves de 'servicios' son texto
+    tipo_txt = df["tipo_servicio"].fillna("nan").astype(str)
+    # int() no admite infinito: esos índices también son inválidos
+    u_ok = u_num.notna() & (u_num.abs() != float("inf"))
+    i_ok = i_num.notna() & (i_num.abs() != float("inf"))
+
+    malo_u = ~u_ok
+    malo_item = u_ok & ~i_ok
+    malo_vr = u_ok & i_ok & v_num.isna()
+    errores.extend(f"Índice de usuario inválido: {v}" for v in df["idx_usuario"][malo_u])
+    errores.extend(
+        f"Índice de ítem inválido para usuario {int(u)}: {v}"
+        for u, v in zip(u_num[malo_item], df["idx_item"][malo_item])
+    )
+    errores.extend(
+        f"Valor de vrServicio_nota inválido para usuario {int(u)}, "
+        f"tipo '{t}', ítem {int(i)}: {v}"
+        for u, t, i, v in zip(
+            u_num[malo_vr], tipo_txt[malo_vr], i_num[malo_vr], df["vrServicio_nota"][malo_vr]
+        )
+    )
 
-        vr_nota = fila["vrServicio_nota"]
-        if pd.isna(vr_nota):
-            continue
+    validas = u_ok & i_ok & v_num.notna()
+    filas = zip(
+        map(int, u_num[validas].tolist()),
+        tipo_txt[validas].tolist(),
+        map(int, i_num[validas].tolist()),
+        map(float, v_num[validas].tolist()),
+    )
 
+    for idx_u, tipo_serv, idx_item, valor_nota in filas:
         if not (0 <= idx_u < len(usuarios_nota)):
             errores.append(f"Índice de usuario {idx_u} fuera de rango en la nota.")
             continue
@@ -387,7 +591,7 @@ def aplicar_plantilla_servicios(
                 )
                 continue
 
-            item_base = copy.deepcopy(lista_fac[idx_item])
+            item_base = clonar_json(lista_fac[idx_item])
             if not isinstance(lista, list):
                 lista = []
             while len(lista) <= idx_item:
@@ -395,32 +599,8 @@ def aplicar_plantilla_servicios(
             lista[idx_item] = item_base
             servicios_nota[tipo_serv] = lista
 
-        lista = servicios_nota.get(tipo_serv, [])
-        if not (isinstance(lista, list) and idx_item < len(lista)):
-            errores.append(
-                f"No se pudo asegurar la estructura de servicios para usuario {idx_u}, "
-                f"tipo '{tipo_serv}', ítem {idx_item}."
-            )
-            continue
-
-        item_nota = lista[idx_item]
+        lista[idx_item]["vrServicio"] = valor_nota
 
-        try:
-            valor_nota = float(vr_nota)
-        except Exception:
-            errores.append(
-                f"Valor de vrServicio_nota inválido para usuario {idx_u}, "
-                f"tipo '{tipo_serv}', ítem {idx_item}: {vr_nota}"
-            )
-            continue
-
-        item_nota["vrServicio"] = valor_nota
-        lista[idx_item] = item_nota
-        servicios_nota[tipo_serv] = lista
-        usuario_nota["servicios"] = servicios_nota
-        usuarios_nota[idx_u] = usuario_nota
-
-    nota["usuarios"] = usuarios_nota
     return nota, errores
 
 
@@ -428,46 +608,88 @@ def aplicar_plantilla_servicios(
 # JSON -> XML (genérico)
 # ==========================
 
-def nota_json_a_xml_element(nota: Dict[str, Any]) -> ET.Element:
+# Además de & < >, se escapan las comillas dobles
+ENTIDADES_TEXTO_XML = {'"': "&quot;"}
+
+
+@functools.lru_cache(maxsize=8192)
+def _texto_xml_cacheado(val: Any) -> str:
+    return escape(str(val), ENTIDADES_TEXTO_XML)
+
+
+def texto_xml(val: Any) -> str:
     """
-    XML genérico para visualizar/exportar el contenido del JSON.
+    Texto escapado de un valor hoja. Códigos, tipos de documento y montos se repiten
+    en miles de ítems, así que str + escape de str/int se guarda en caché. Los float no:
+    0.0 y -0.0 son iguales como clave pero se escriben distinto.
+    """
+    if type(val) is str or type(val) is int:
+        return _texto_xml_cacheado(val)
+    return escape(str(val), ENTIDADES_TEXTO_XML)
+
+
+def nota_json_a_xml_bytes(nota: Dict[str, Any]) -> bytes:
+    """
+    XML genérico con sangría para visualizar/exportar el contenido del JSON.
     No es un XML oficial DIAN ni Minsalud, solo una representación estructurada.
+    Se escribe directamente sobre un buffer mientras se recorre el JSON.
     """
-    root = ET.Element("RipsDocumento")
+    buffer = BytesIO()
+    salida = TextIOWrapper(buffer, encoding="utf-8", newline="\n")
+    w = salida.write
+
+    def hoja(tag: Any, val: Any, sangria: str) -> None:
+        texto = "" if val is None else texto_xml(val)
+        if texto:
+            w(f"{sangria}<{tag}>{texto}</{tag}>\n")
+        else:
+            w(f"{sangria}<{tag}/>\n")
+
+    w('<?xml version="1.0" encoding="utf-8"?>\n<RipsDocumento>\n')
     for key, val in nota.items():
         if key == "usuarios":
             continue
-        child = ET.SubElement(root, key)
-        child.text = "" if val is None else str(val)
-
-    usuarios_el = ET.SubElement(root, "usuarios")
-    for u in nota.get("usuarios", []):
-        u_el = ET.SubElement(usuarios_el, "usuario")
-        for key, val in u.items():
-            if key == "servicios":
-                serv_el = ET.SubElement(u_el, "servicios")
-                if isinstance(val, dict):
-                    for tipo_serv, lista in val.items():
-                        tipo_el = ET.SubElement(serv_el, str(tipo_serv))
-                        if isinstance(lista, list):
-                            for item in lista:
-                                item_el = ET.SubElement(tipo_el, "item")
-                                if isinstance(item, dict):
-                                    for kk, vv in item.items():
-                                        campo_el = ET.SubElement(item_el, str(kk))
-                                        campo_el.text = "" if vv is None else str(vv)
-                continue
-            campo_el = ET.SubElement(u_el, str(key))
-            campo_el.text = "" if val is None else str(val)
-    return root
-
+        hoja(key, val, "  ")
 
-def nota_json_a_xml_bytes(nota: Dict[str, Any]) -> bytes:
-    elem = nota_json_a_xml_element(nota)
-    rough_xml = ET.tostring(elem, encoding="utf-8")
-    dom = minidom.parseString(rough_xml)
-    pretty = dom.toprettyxml(indent="  ", encoding="utf-8")
-    return pretty
+    usuarios = nota.get("usuarios", [])
+    if not usuarios:
+        w("  <usuarios/>\n")
+    else:
+        w("  <usuarios>\n")
+        for u in usuarios:
+            if not u:
+                w("    <usuario/>\n")
+                continue
+            w("    <usuario>\n")
+            for key, val in u.items():
+                if key != "servicios":
+                    hoja(key, val, "      ")
+                    continue
+                if not (isinstance(val, dict) and val):
+                    w("      <servicios/>\n")
+                    continue
+                w("      <servicios>\n")
+                for tipo_serv, lista in val.items():
+                    if not (isinstance(lista, list) and lista):
+                        w(f"        <{tipo_serv}/>\n")
+                        continue
+                    w(f"        <{tipo_serv}>\n")
+                    for item in lista:
+                        if not (isinstance(item, dict) and item):
+                            w("          <item/>\n")
+                            continue
+                        w("          <item>\n")
+                        for kk, vv in item.items():
+                            hoja(kk, vv, "            ")
+                        w("          </item>\n")
+                    w(f"        </{tipo_serv}>\n")
+                w("      </servicios>\n")
+            w("    </usuario>\n")
+        w("  </usuarios>\n")
+    w("</RipsDocumento>\n")
+
+    salida.flush()
+    return buffer.getvalue()
 
 
 # ==========================
@@ -482,12 +704,96 @@ def cargar_json_en_estado(uploaded_file, state_key: str, name_key: str) -> None:
     if nombre_actual == nombre_subido and state_key in st.session_state:
         return
     try:
-        data = json.load(uploaded_file)
+        data = leer_json(uploaded_file.getvalue())
     except Exception as exc:
         st.error(f"No se pudo leer el JSON '{nombre_subido}': {exc}")
         return
     st.session_state[state_key] = data
     st.session_state[name_key] = nombre_subido
+    st.session_state.pop(f"{state_key}_resumen", None)
+    marcar_modificado(state_key)
+
+
+PREFIJO_CACHE_EDITOR = "servicios_str_"
+
+
+def invalidar_cache_editor() -> None:
+    """Descarta los textos JSON cacheados del editor individual (tras cambiar nota o factura)."""
+    for clave in [k for k in st.session_state.keys() if str(k).startswith(PREFIJO_CACHE_EDITOR)]:
+        del st.session_state[clave]
+
+
+def marcar_modificado(state_key: str) -> None:
+    """
+    Recalcula la versión del documento tras cargarlo o modificarlo. Los artefactos
+    derivados se cachean por esa versión, así un rerun sin cambios no vuelve a hashear ni
+    a recorrer el JSON. La versión es la huella del contenido: como st.cache_data es
+    compartido entre sesiones, dos sesiones solo comparten entrada si el documento es igual.
+    """
+    st.session_state[f"{state_key}_version"] = huella_json(st.session_state.get(state_key))
+    invalidar_cache_editor()
+
+
+def version_documento(state_key: str) -> Optional[str]:
+    """Versión actual del documento; si hay datos sin versión (no pasaron por la carga), se crea."""
+    clave = f"{state_key}_version"
+    if clave not in st.session_state and st.session_state.get(state_key) is not None:
+        st.session_state[clave] = huella_json(st.session_state[state_key])
+    return st.session_state.get(clave)
+
+
+# Los argumentos con guion bajo no los hashea st.cache_data: la clave son solo las versiones
+@st.cache_data(show_spinner=False, max_entries=4)
+def claves_por_version(
+    version_factura: Optional[str],
+    version_nota: Optional[str],
+    _factura: Optional[Dict[str, Any]],
+    _nota: Dict[str, Any],
+) -> List[str]:
+    return obtener_claves_servicio_esperadas(_factura, _nota)
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def resumen_por_version(version_nota: Optional[str], _nota: Dict[str, Any]) -> pd.DataFrame:
+    return generar_resumen_usuarios(_nota)
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def plantilla_por_version(
+    version_nota: Optional[str],
+    version_factura: Optional[str],
+    _nota: Dict[str, Any],
+    _factura: Optional[Dict[str, Any]],
+) -> Tuple[BytesIO, str, str]:
+    return generar_plantilla_servicios(_nota, _factura)
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def json_por_version(version_nota: Optional[str], indentar: bool, _nota: Dict[str, Any]) -> bytes:
+    return serializar_json(_nota, indentar=indentar)
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def xml_por_version(version_nota: Optional[str], _nota: Dict[str, Any]) -> bytes:
+    return nota_json_a_xml_bytes(_nota)
+
+
+def resumen_cabecera(state_key: str) -> Dict[str, Any]:
+    """
+    Datos de cabecera que se muestran de cada documento. Se calculan una vez por archivo
+    cargado: las ediciones solo tocan 'servicios', no la cabecera ni el número de usuarios.
+    """
+    cache_key = f"{state_key}_resumen"
+    if cache_key not in st.session_state:
+        doc = st.session_state.get(state_key) or {}
+        st.session_state[cache_key] = {
+            "numDocumentoIdObligado": doc.get("numDocumentoIdObligado"),
+            "numFactura": doc.get("numFactura"),
+            "tipoNota": doc.get("tipoNota"),
+            "numNota": doc.get("numNota"),
+            "totalUsuarios": len(doc.get("usuarios", [])),
+        }
+    return st.session_state[cache_key]
 
 
 def obtener_nota() -> Optional[Dict[str, Any]]:
@@ -545,15 +851,7 @@ def main():
         st.subheader("📄 Factura / JSON de referencia")
         if factura_data:
             st.markdown(f"**Archivo:** `{st.session_state.get('factura_name')}`")
-            st.json(
-                {
-                    "numDocumentoIdObligado": factura_data.get("numDocumentoIdObligado"),
-                    "numFactura": factura_data.get("numFactura"),
-                    "tipoNota": factura_data.get("tipoNota"),
-                    "numNota": factura_data.get("numNota"),
-                    "totalUsuarios": len(factura_data.get("usuarios", [])),
-                }
-            )
+            st.json(resumen_cabecera("factura_data"))
         else:
             st.info("Suba un JSON de factura completa (opcional, pero necesario si la nota viene sin servicios).")
 
@@ -561,27 +859,21 @@ def main():
         st.subheader("🧾 Nota / JSON a corregir (SE EDITA ESTE)")
         if nota_data:
             st.markdown(f"**Archivo:** `{st.session_state.get('nota_name')}`")
-            st.json(
-                {
-                    "numDocumentoIdObligado": nota_data.get("numDocumentoIdObligado"),
-                    "numFactura": nota_data.get("numFactura"),
-                    "tipoNota": nota_data.get("tipoNota"),
-                    "numNota": nota_data.get("numNota"),
-                    "totalUsuarios": len(nota_data.get("usuarios", [])),
-                }
-            )
+            st.json(resumen_cabecera("nota_data"))
         else:
             st.info("Suba el JSON de la nota/crédito o archivo RIPS incompleto.")
     if not nota_data:
         st.stop()
 
-    claves_esperadas = obtener_claves_servicio_esperadas(factura_data, nota_data)
+    claves_esperadas = claves_por_version(
+        version_documento("factura_data"), version_documento("nota_data"), factura_data, nota_data
+    )
 
     # 2. Resumen usuarios
     st.markdown("---")
     st.subheader("2️⃣ Resumen y validación de usuarios")
 
-    df_resumen = generar_resumen_usuarios(nota_data)
+    df_resumen = resumen_por_version(version_documento("nota_data"), nota_data)
     if df_resumen.empty:
         st.warning("El JSON de la nota no contiene usuarios.")
     else:
@@ -629,12 +921,14 @@ def main():
                 signo = -1
         with col_boton:
             if st.button("Rellenar servicios vacíos desde factura"):
-                nota_trabajo = copy.deepcopy(nota_data)
-                nota_actualizada, resumen = copiar_servicios_factura_a_nota(
-                    factura_data, nota_trabajo, signo
-                )
-                st.session_state["nota_data"] = nota_actualizada
-                nota_data = nota_actualizada
+                try:
+                    nota_actualizada, resumen = copiar_servicios_factura_a_nota(
+                        factura_data, nota_data, signo
+                    )
+                    st.session_state["nota_data"] = nota_actualizada
+                    nota_data = nota_actualizada
+                finally:
+                    marcar_modificado("nota_data")
                 st.success(
                     f"Servicios copiados. Usuarios modificados: {resumen['usuarios_modificados']}, "
                     f"ya tenían servicios: {resumen['usuarios_ya_tenian_servicios']}, "
@@ -693,11 +987,14 @@ def main():
             servicios_visuales = {}
             origen = "vacio"
 
-        # Editor JSON crudo
-        if origen in ("nota", "factura"):
-            servicios_str = json.dumps(servicios_visuales, ensure_ascii=False, indent=2)
-        else:
-            servicios_str = "{}"
+        # Editor JSON crudo; el texto se guarda por usuario hasta que cambie la nota o la factura
+        cache_key = f"{PREFIJO_CACHE_EDITOR}{idx_sel}"
+        if cache_key not in st.session_state:
+            if origen in ("nota", "factura"):
+                st.session_state[cache_key] = serializar_json(servicios_visuales, indentar=True).decode("utf-8")
+            else:
+                st.session_state[cache_key] = "{}"
+        servicios_str = st.session_state[cache_key]
 
         servicios_editados = st.text_area(
             (
@@ -711,14 +1008,12 @@ def main():
 
         if st.button("Guardar cambios en este usuario (NOTA)"):
             try:
-                servicios_nuevos = json.loads(servicios_editados)
+                servicios_nuevos = leer_json(servicios_editados)
             except json.JSONDecodeError as exc:
                 st.error(f"El JSON de servicios no es válido: {exc}")
             else:
                 usuario_nota["servicios"] = servicios_nuevos
-                usuarios_nota[idx_sel] = usuario_nota
-                nota_data["usuarios"] = usuarios_nota
-                st.session_state["nota_data"] = nota_data
+                marcar_modificado("nota_data")
                 st.success("Servicios actualizados correctamente en el JSON de la NOTA para este usuario.")
 
     # 5. Masivo con plantilla
@@ -744,22 +1039,37 @@ def main():
     col_descarga, col_subida = st.columns(2)
 
     with col_descarga:
-        buffer, ext, mime = generar_plantilla_servicios(nota_data, factura_data)
-        st.download_button(
-            "⬇️ Descargar plantilla de servicios (Excel si es posible, si no CSV)",
-            data=buffer,
-            file_name=f"plantilla_servicios_rips.{ext}",
-            mime=mime,
-        )
+        # Plantilla generada a pedido; vale mientras no cambien la nota ni la factura
+        versiones_plantilla = (version_documento("nota_data"), version_documento("factura_data"))
+        if st.button("Preparar plantilla de servicios"):
+            st.session_state["plantilla_preparada"] = (
+                versiones_plantilla,
+                plantilla_por_version(*versiones_plantilla, nota_data, factura_data),
+            )
+        preparada = st.session_state.get("plantilla_preparada")
+        if preparada and preparada[0] == versiones_plantilla:
+            buffer, ext, mime = preparada[1]
+            st.download_button(
+                "⬇️ Descargar plantilla de servicios (Excel si es posible, si no CSV)",
+                data=buffer,
+                file_name=f"plantilla_servicios_rips.{ext}",
+                mime=mime,
+            )
+        elif preparada:
+            st.caption("La nota o la factura cambiaron: prepare de nuevo la plantilla.")
 
     with col_subida:
         if plantilla_file is not None:
             if st.button("Aplicar cambios desde plantilla"):
-                nota_actualizada, errores = aplicar_plantilla_servicios(
-                    nota_data, factura_data, plantilla_file
-                )
-                st.session_state["nota_data"] = nota_actualizada
-                nota_data = nota_actualizada
+                try:
+                    nota_actualizada, errores = aplicar_plantilla_servicios(
+                        nota_data, factura_data, plantilla_file
+                    )
+                    st.session_state["nota_data"] = nota_actualizada
+                    nota_data = nota_actualizada
+                finally:
+                    # La plantilla se aplica fila por fila: se versiona aunque una fila falle
+                    marcar_modificado("nota_data")
                 if errores:
                     st.warning("Se aplicaron los cambios, pero hubo advertencias:")
                     for e in errores:
@@ -771,26 +1081,35 @@ def main():
     st.markdown("---")
     st.subheader("6️⃣ Descargar JSON y XML resultantes")
 
-    nota_json_bytes = json.dumps(nota_data, ensure_ascii=False, indent=2).encode("utf-8")
-    nombre_nota_base = st.session_state.get("nota_name") or "nota_corregida"
+    # JSON compacto por defecto
+    json_legible = st.checkbox("Descargar JSON legible (con sangría)", value=False)
+    nota_json_bytes = json_por_version(version_documento("nota_data"), json_legible, nota_data)
+    nombre_nota_base = (st.session_state.get("nota_name") or "nota_corregida").rsplit(".", 1)[0]
 
     col_json, col_xml = st.columns(2)
     with col_json:
         st.download_button(
             "⬇️ Descargar JSON corregido (NOTA)",
             data=nota_json_bytes,
-            file_name=f"{nombre_nota_base.rsplit('.', 1)[0]}_corregida.json",
+            file_name=f"{nombre_nota_base}_corregida.json",
             mime="application/json",
         )
 
     with col_xml:
-        xml_bytes = nota_json_a_xml_bytes(nota_data)
-        st.download_button(
-            "⬇️ Descargar XML generado desde JSON de la nota",
-            data=xml_bytes,
-            file_name=f"{nombre_nota_base.rsplit('.', 1)[0]}.xml",
-            mime="application/xml",
-        )
+        # XML generado a pedido; vale mientras no cambie la nota
+        version_nota = version_documento("nota_data")
+        if st.button("Preparar XML"):
+            st.session_state["xml_preparado"] = (version_nota, xml_por_version(version_nota, nota_data))
+        preparado = st.session_state.get("xml_preparado")
+        if preparado and preparado[0] == version_nota:
+            st.download_button(
+                "⬇️ Descargar XML generado desde JSON de la nota",
+                data=preparado[1],
+                file_name=f"{nombre_nota_base}.xml",
+                mime="application/xml",
+            )
+        elif preparado:
+            st.caption("La nota cambió: prepare de nuevo el XML.")
 
 
 if __name__ == "__main__":